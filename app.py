@@ -1,35 +1,97 @@
+import io
 import os
+import re
+import hmac
 import json
+import hashlib
+import datetime
 import tempfile
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import threading
 import time
+import atexit
+import itertools
+import random
 import base64
+import queue
 import requests
 
-from flask import Flask, request, abort
+import google.generativeai as genai
+from google.generativeai import caching as genai_caching
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from flask import Flask, request, abort, Response
 from dotenv import load_dotenv
+# SDK 模組在啟動時一次載完（genai 會拖進 gRPC/protobuf，linebot 拖進
+# pydantic model），不讓第一個 webhook 付這筆 100ms～1s 的 import 成本；
+# 需要讀環境變數的設定物件仍維持 lazy 建構
+from linebot.v3.messaging import (
+    ApiClient,
+    Configuration,
+    FlexContainer,
+    FlexMessage,
+    MessagingApi,
+    PushMessageRequest,
+    ReplyMessageRequest,
+    TextMessage,
+)
 
 load_dotenv()
 
 app = Flask(__name__)
+app.url_map.strict_slashes = False
+
+# 回應壓縮（flask-compress 未安裝時靜默略過，不影響功能）
+try:
+    from flask_compress import Compress
+    Compress(app)
+except ImportError:
+    pass
 
-# 設定 logging
-logging.basicConfig(level=logging.INFO)
+# 設定 logging：handler 只把紀錄丟進佇列，實際的 stdout 寫入由
+# QueueListener 的背景執行緒處理，request 路徑不用等同步 I/O
+_log_queue = queue.SimpleQueue()
+_log_output_handler = logging.StreamHandler()
+_log_output_handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+# QueueHandler.prepare 會先用自己的 formatter 把訊息烘進 record，等級/名稱
+# 前綴只能留給 listener 端的 handler 加，否則每行都會出現兩次前綴
+logging.basicConfig(level=logging.INFO, format='%(message)s',
+                    handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, _log_output_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# JSON 熱路徑（webhook 事件、AI 回應、Flex 模板）優先用 orjson（C 實作），
+# 未安裝時退回標準庫，行為相同
+try:
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
 # 載入環境變數
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
 
-# 支援多把 Gemini API Key 輪替使用（動態掃描所有 GEMINI_API_KEY* 環境變數）
-GEMINI_API_KEYS = []
-_key_names = ['GEMINI_API_KEY'] + [f'GEMINI_API_KEY_{i}' for i in range(2, 21)]
-for key_name in _key_names:
-    key = os.environ.get(key_name, '')
-    if key:
-        GEMINI_API_KEYS.append(key)
-        logger.info(f"Loaded key from {key_name}")
+# 支援多把 Gemini API Key 輪替使用：掃一次環境變數，名稱以 GEMINI_API_KEY
+# 開頭的都收（排序保持 GEMINI_API_KEY, GEMINI_API_KEY_2, ... 的穩定順序），
+# 加到第 21 把以上也不用改程式。只記錄數量，不把變數名稱洩漏進 log
+GEMINI_API_KEYS = [
+    os.environ[name] for name in sorted(os.environ)
+    if name.startswith('GEMINI_API_KEY') and os.environ[name]
+]
 logger.info(f"Total Gemini API keys loaded: {len(GEMINI_API_KEYS)}")
 
 
@@ -38,7 +100,14 @@ class QuotaExhaustedError(Exception):
     pass
 
 
-_current_key_index = 0  # 目前使用的 Key 索引
+class GeminiKeysBusyError(Exception):
+    """所有 Gemini key 暫時忙碌（冷卻／限流中），稍後重試可望成功"""
+    pass
+
+
+# 輪替起點用 itertools.count 產生：next() 在 GIL 下是原子操作，
+# 多執行緒同時取號也不會拿到同一把 key（舊的共用 int 會 race）
+_key_counter = itertools.count()
 
 # --- 速率限制 & 冷卻機制 ---
 _key_cooldown = {}          # {key_index: cooldown_until_timestamp}
@@ -47,16 +116,281 @@ _last_request_time = 0      # 上次 API 請求的時間戳
 _rate_lock = threading.Lock()  # 保護共享狀態的鎖
 
 # 冷卻時間設定（秒）
-PER_KEY_COOLDOWN = 60       # 單把 key 被 429 後暫停 60 秒
+PER_KEY_COOLDOWN = 60       # 單把 key 被 429 後暫停 60 秒（無官方建議值時的保底）
 GLOBAL_COOLDOWN = 120       # 所有 key 都耗盡後暫停 120 秒
 MIN_REQUEST_INTERVAL = 2    # 連續 API 請求間最少間隔 2 秒
 
-# 延遲初始化
-line_configuration = None
-line_handler = None
+# 429 回應通常帶著官方建議的等待時間：HTTP 的 Retry-After header，或 Gemini
+# 嵌在錯誤訊息裡的 retryDelay（"retryDelay": "32s" / retry_delay { seconds: 32 }）。
+# 有就照官方數字冷卻——比固定 60 秒猜測更不浪費額度、也更不會提前再撞 429。
+_RETRY_DELAY_RE = re.compile(r'retry[_-]?delay\D{0,12}?(\d+)', re.IGNORECASE)
 
-# 固定使用的 Gemini 模型（不再動態偵測，節省 API 配額）
-GEMINI_MODEL = 'gemini-2.5-flash'
+
+def _retry_after_from_error(error, error_str, default):
+    """從 429 例外取出建議冷卻秒數，header 優先、訊息內嵌其次、沒有就用 default"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is not None:
+        value = headers.get('Retry-After')
+        if value:
+            try:
+                return max(1, int(float(value)))
+            except (TypeError, ValueError):
+                pass
+    match = _RETRY_DELAY_RE.search(error_str)
+    if match:
+        return max(1, int(match.group(1)))
+    return default
+
+# --- per-key token bucket ---
+# 冷卻只是 429 之後的二元懲罰：懲罰前照樣連打到撞牆、懲罰一結束又整群湧回。
+# 平時改由 token bucket 按已知的 RPM 平滑放行，貼著配額走而不是撞上去。
+GEMINI_KEY_RPM = float(os.environ.get('GEMINI_KEY_RPM', 10))  # 單把 key 每分鐘請求數
+GEMINI_KEY_BURST = max(2.0, GEMINI_KEY_RPM / 2)               # 突發容量（token 上限）
+_key_buckets = {}  # {key_index: [tokens, last_refill_ts]}
+
+
+def _try_acquire_key_token(key_index):
+    """token bucket：依 GEMINI_KEY_RPM 速率補充，有足夠 token 才放行"""
+    now = time.time()
+    rate = GEMINI_KEY_RPM / 60.0
+    with _rate_lock:
+        bucket = _key_buckets.get(key_index)
+        if bucket is None:
+            bucket = [GEMINI_KEY_BURST, now]
+            _key_buckets[key_index] = bucket
+        bucket[0] = min(GEMINI_KEY_BURST, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return True
+        return False
+
+
+# --- per-key 健康分數 ---
+# 各把 key 剩餘配額通常不對稱（有的白天已被用掉大半），純輪替會把快耗盡的
+# key 和新鮮的 key 等量分配。以分數記錄近期成敗：成功緩慢回血、429 大扣分，
+# 選 key 時高分者優先，流量自然流向還健康的 key，減少 429 與重試輪數。
+KEY_SCORE_MAX = 100
+KEY_SCORE_SUCCESS_GAIN = 1
+KEY_SCORE_FAIL_PENALTY = 20
+AUTH_FAILURE_COOLDOWN = 86400  # 401/403 多半是 key 被撤銷或打錯，冷卻 24 小時
+_key_scores = {}  # {key_index: 0 ~ KEY_SCORE_MAX}
+
+
+def _bump_key_score(key_index, delta):
+    with _rate_lock:
+        score = _key_scores.get(key_index, KEY_SCORE_MAX)
+        _key_scores[key_index] = max(0, min(KEY_SCORE_MAX, score + delta))
+
+# LINE SDK 設定在 import 時就建好：cold start 的第一個 webhook
+# 不必再付 SDK import ＋初始化的成本（Render 冷啟動時可達數百 ms）
+line_configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN) if LINE_CHANNEL_ACCESS_TOKEN else None
+
+# --- 背景工作執行緒池 ---
+# 固定大小的執行緒池取代「每個事件各開一條 thread」：
+# 同時進行的 Gemini 呼叫數有上限，突發流量不會讓 thread 數量爆炸
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 8))
+MAX_PENDING_TASKS = WORKER_THREADS * 2  # 排隊超過此數直接回覆「系統繁忙」
+_EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix='baby-bot')
+# wait=False：關機時不等排隊中的影像處理完（LINE 會重送 webhook）
+atexit.register(_EXECUTOR.shutdown, wait=False)
+_pending_tasks = 0             # 執行中＋排隊中的工作數
+_pending_lock = threading.Lock()
+
+
+class _TTLCache:
+    """精簡版 TTL cache（dict + 到期時間戳），免得為這點功能多拉一個相依套件"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}  # {key: (expires_at, value)}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if now >= entry[0]:
+                del self._data[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """寫入一筆；ttl 可針對單筆覆寫（預設用整個 cache 的 TTL）"""
+        now = time.time()
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                # 先清過期項目，不夠再從最舊的開始淘汰（dict 保留插入順序）
+                for k in [k for k, (exp, _) in self._data.items() if exp <= now]:
+                    del self._data[k]
+                while len(self._data) >= self.maxsize:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+
+    def add(self, key):
+        """若 key 不存在（或已過期）則寫入並回傳 True，否則回傳 False（原子操作）"""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and now < entry[0]:
+                return False
+            self._data[key] = (now + self.ttl, True)
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# --- AI 結果快取 ---
+# 同一張超音波照在親友間轉傳後重送很常見；以影像內容的雜湊為 key 快取
+# 解析後的結果，命中時完全跳過 AI（最快的回應就是不用呼叫）。
+# prompt 模板或模型改版時請調升版本字首，讓舊結果自然失效。
+RESULT_CACHE_VERSION = 'v1'
+_result_cache = _TTLCache(maxsize=1024, ttl=86400)
+# OpenRouter 備援的結果品質參差，只短暫快取：Gemini 恢復後同一張照片
+# 還有機會重新分析，不會被備援結果釘住一整天
+FALLBACK_RESULT_TTL = 3600
+
+
+def _image_cache_key(image_bytes):
+    """結果快取的 key — 優先用感知雜湊（dHash）
+
+    同一張超音波照被轉傳、另存後位元組會變（重新壓縮），精確雜湊就 miss；
+    dHash 只看灰階畫面的相鄰亮度梯度，重壓縮後依然相同。取 17x16 灰階、
+    256 bit 的版本而非常見的 9x8：超音波照本來就都偏暗、構圖相近，
+    位元數多一個數量級可以把不同張誤撞同一格的機率壓到可忽略。
+    Pillow 不可用時退回精確雜湊，行為不變只是命中率低一點。
+    """
+    if Image is not None:
+        try:
+            img = Image.open(io.BytesIO(image_bytes)).convert('L').resize((17, 16))
+            pixels = list(img.getdata())
+            bits = 0
+            for row in range(16):
+                base = row * 17
+                for col in range(16):
+                    bits = (bits << 1) | (pixels[base + col] > pixels[base + col + 1])
+            return f'{RESULT_CACHE_VERSION}-babybot-dhash:{bits:064x}'
+        except Exception as e:
+            logger.warning(f"dHash failed ({e}), falling back to exact hash")
+    digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    return f'{RESULT_CACHE_VERSION}-babybot-scan:{digest}'
+
+
+# --- webhook 重送去重 ---
+# 第一次回覆超過 1 秒時 LINE 會重送 webhook；同一個 message_id
+# 處理兩次等於白白多付一次 Gemini 的錢，在入口就擋掉
+_inflight_messages = _TTLCache(maxsize=4096, ttl=120)
+
+# 使用的 Gemini 模型（不再動態偵測，節省 API 配額）。
+# OCR 幾個數字＋判斷 2D/3D 對 flash-lite 來說綽綽有餘，TTFT 明顯更低；
+# 想 A/B 其他模型時用 GEMINI_MODEL 環境變數切換即可。
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash-lite')
+
+# 結構化輸出：強制 Gemini 直接回乾淨 JSON，
+# 不再需要剝 markdown fence，也幾乎不會走到 JSONDecodeError fallback
+_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'weeks': {'type': 'string'},
+        'weight_status': {'type': 'string'},
+        'message': {'type': 'string'},
+        'suggested_color': {'type': 'string'},
+    },
+    'required': ['weeks', 'weight_status', 'message', 'suggested_color'],
+}
+_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': _RESPONSE_SCHEMA,
+}
+
+# genai.configure 與 GenerativeModel 建構都有不小的初始化成本，
+# 只在 key 真的切換時 configure、模型物件按 (key, cache) 重複使用。
+# 注意：模型物件會綁住第一次呼叫時的 client，所以必須按 key 各存一份。
+_configured_key = None
+_model_cache = {}  # {(key_index, prompt_cache_name 或 None): GenerativeModel}
+
+# genai.configure 換的是「行程全域」的 client，而上傳、CachedContent 與模型
+# 首次呼叫用的都是當下的全域 client——configure 到 generate 之間若被另一條
+# worker 的 configure 插隊，就會拿 A key 上傳、B key 生成（檔案找不到），
+# 模型還會綁到錯的 key 被永久快取。整段必須在同一把鎖內完成；
+# 反正 MIN_REQUEST_INTERVAL 已經把 Gemini 呼叫全域排開，序列化幾乎不花錢
+_gemini_call_lock = threading.Lock()
+
+
+def _configure_gemini(key_index):
+    """切換 genai 全域 API key（同一把 key 連續使用時不重複 configure）"""
+    global _configured_key
+    api_key = GEMINI_API_KEYS[key_index]
+    if api_key != _configured_key:
+        genai.configure(api_key=api_key)
+        _configured_key = api_key
+
+
+def _get_model(key_index, prompt_cache=None):
+    """取得（或建立）目前 key 對應的 GenerativeModel"""
+    cache_name = prompt_cache.name if prompt_cache is not None else None
+    model_key = (key_index, cache_name)
+    model = _model_cache.get(model_key)
+    if model is None:
+        if prompt_cache is not None:
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=prompt_cache,
+                generation_config=_GENERATION_CONFIG,
+            )
+        else:
+            model = genai.GenerativeModel(GEMINI_MODEL, generation_config=_GENERATION_CONFIG)
+        _model_cache[model_key] = model
+    return model
+
+# --- Gemini 暫存檔背景清理 ---
+# delete_file 是單純的善後 RPC（~50-200ms），使用者不該等它；
+# 丟進佇列由 daemon thread 定期批次清除，一次 drain 攤平喚醒成本
+_file_cleanup_queue = queue.SimpleQueue()
+FILE_CLEANUP_INTERVAL = 60  # 批次清理間隔（秒）；善後不趕時間，批次越大攤提越好
+
+
+def _file_cleanup_loop():
+    while True:
+        time.sleep(FILE_CLEANUP_INTERVAL)
+        names = []
+        try:
+            while True:
+                names.append(_file_cleanup_queue.get_nowait())
+        except queue.Empty:
+            pass
+        for name in names:
+            try:
+                genai.delete_file(name)
+            except Exception:
+                # key 已輪替或檔案已不存在都會失敗；Gemini 48 小時後
+                # 會自動刪除上傳檔，失敗就交給 TTL 處理
+                pass
+        if names:
+            logger.info(f"Cleaned up {len(names)} Gemini temp files")
+
+
+threading.Thread(target=_file_cleanup_loop, daemon=True, name='gemini-cleanup').start()
+
+# --- Gemini service tier 設定 ---
+# priority: 高優先佇列，毫秒～秒級回應（線上回覆用，避免 reply token 過期）
+# flex:     約五折價格，延遲不敏感的離線／開發環境適用
+# 留空則使用預設的 Standard tier
+GEMINI_SERVICE_TIER = os.environ.get('GEMINI_SERVICE_TIER', 'priority')
+_service_tier_supported = True  # SDK 不支援 service_tier 時自動停用
+
+# --- Gemini context caching ---
+# 系統 prompt 每次請求都重送會重複付 input token 錢，改成 context cache
+# 後只付一次，之後以 handle 引用（約 9 折優惠 + 更快的 TTFT）。
+# prompt 內容變更時請調升版本號，讓舊 cache 自然過期。
+PROMPT_CACHE_KEY = 'v1-baby-bot-system-prompt'
+PROMPT_CACHE_TTL = 3600          # cache 存活秒數
+PROMPT_CACHE_REFRESH_MARGIN = 300  # 提前 5 分鐘視為過期，避免用到剛失效的 cache
+_prompt_caches = {}  # {key_index: (CachedContent 或 None, expires_at)}
 
 # --- OpenRouter 備援設定 ---
 OPENROUTER_API_KEY = os.environ.get('OPENROUTER_API_KEY', '')
@@ -67,39 +401,241 @@ OPENROUTER_FREE_MODELS = [
     'meta-llama/llama-3.2-11b-vision-instruct:free',
     'google/gemma-3-4b-it:free',
 ]
+# 被 429 的模型照 Retry-After 冷卻，期間不再列入備援名單
+OPENROUTER_MODEL_COOLDOWN = 60  # Retry-After 缺席時的保底秒數
+_openrouter_model_cooldown = {}  # {model: cooldown_until_timestamp}
+# 長駐 Session：連線池 + keep-alive，三個模型並發重試都不必重握 TLS；
+# 固定標頭直接掛在 session 上，省掉每次呼叫的 dict 合併。
+# max_retries=0——重試策略由上層的模型競速負責，不讓 urllib3 自己加戲
+_openrouter_session = requests.Session()
+_openrouter_session.mount(
+    'https://',
+    requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0),
+)
+_openrouter_session.headers.update({
+    'Authorization': f'Bearer {OPENROUTER_API_KEY}',
+    'Content-Type': 'application/json',
+    'HTTP-Referer': 'https://baby-bot.onrender.com',
+    'X-Title': 'Baby Bot',
+})
 if OPENROUTER_API_KEY:
     logger.info(f"OpenRouter fallback enabled with {len(OPENROUTER_FREE_MODELS)} free models")
 else:
     logger.warning("OPENROUTER_API_KEY not set — fallback disabled")
 
+# --- LINE Content API 直接下載 ---
+# 用長駐的 Session（連線池 + keep-alive）直接打 Content API，
+# 省掉 SDK 每個請求重建 ApiClient／TLS 握手的成本
+LINE_CONTENT_URL = 'https://api-data.line.me/v2/bot/message/{message_id}/content'
+_line_content_session = requests.Session()
+
+# --- 長駐的 LINE Messaging API client ---
+# 原本每個請求進出兩次 `with ApiClient(...)`，連線池和 TLS session 各建各拆；
+# 改成整個 worker 共用一個 client，對 api.line.me 的連線維持 keep-alive
+_line_api_client = None
+_line_messaging_api = None
+_line_client_lock = threading.Lock()
+
+
+def _get_messaging_api():
+    """取得共用的 MessagingApi 實例（第一次呼叫時建立）"""
+    global _line_api_client, _line_messaging_api
+    if _line_messaging_api is None:
+        with _line_client_lock:
+            if _line_messaging_api is None:
+                _line_api_client = ApiClient(line_configuration)
+                if hasattr(_line_api_client, 'close'):
+                    atexit.register(_line_api_client.close)
+                _line_messaging_api = MessagingApi(_line_api_client)
+    return _line_messaging_api
+
+# 影像超過此大小才落地到磁碟（正常超音波照遠小於此，直接留在記憶體）
+MAX_IN_MEMORY_IMAGE = 8 * 1024 * 1024
+
+# --- 影像前處理 ---
+# Gemini 內部只以 768px tile 處理影像，原圖 3000px 上傳純粹浪費頻寬
+# 和 input token（每個 tile 都計費）；先縮到最長邊 1024px 再上傳。
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MAX_IMAGE_DIMENSION = 1024
+RESIZED_JPEG_QUALITY = 85
+
+
+def _prepare_image(image_bytes):
+    """把過大的影像縮到最長邊 1024px 並重新壓縮；失敗時原樣送出"""
+    if Image is None:
+        return image_bytes
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if max(img.size) <= MAX_IMAGE_DIMENSION:
+            return image_bytes
+        img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=RESIZED_JPEG_QUALITY, optimize=True)
+        resized = out.getvalue()
+        logger.info('Image resized for upload: %d -> %d bytes', len(image_bytes), len(resized))
+        return resized
+    except Exception as e:
+        logger.warning(f"Image resize failed ({e}), uploading original bytes")
+        return image_bytes
 
-def get_line_config():
-    global line_configuration, line_handler
-    if line_configuration is None:
-        from linebot.v3.messaging import Configuration
-        from linebot.v3 import WebhookHandler
-        line_configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-        line_handler = WebhookHandler(LINE_CHANNEL_SECRET)
-        _register_handlers()
-    return line_configuration, line_handler
-
-
-def _register_handlers():
-    """註冊 LINE webhook 事件處理器"""
-    from linebot.v3.webhooks import MessageEvent, ImageMessageContent
-
-    @line_handler.add(MessageEvent, message=ImageMessageContent)
-    def handle_image_message(event):
-        user_id = event.source.user_id
-        message_id = event.message.id
-        reply_token = event.reply_token
-        thread = threading.Thread(
-            target=_process_image_async,
-            args=(user_id, message_id, reply_token)
-        )
-        thread.start()
+
+DOWNLOAD_CHUNK_SIZE = 65536
+
+
+def _download_line_image(message_id):
+    """從 LINE Content API 下載影像，回傳 bytes
+
+    LINE 的影像回應帶 Content-Length，先一次配好 bytearray 再按位移填入，
+    避免邊讀邊串接造成的重複擴容搬移。
+    """
+    resp = _line_content_session.get(
+        LINE_CONTENT_URL.format(message_id=message_id),
+        headers={'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'},
+        timeout=30,
+        stream=True,
+    )
+    resp.raise_for_status()
+
+    try:
+        content_length = int(resp.headers.get('Content-Length', 0))
+    except (TypeError, ValueError):
+        content_length = 0
+
+    if content_length <= 0:
+        # 沒有長度資訊就退回一般的串接讀法
+        return b''.join(resp.iter_content(DOWNLOAD_CHUNK_SIZE))
+
+    buf = bytearray(content_length)
+    offset = 0
+    for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+        buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return bytes(buf[:offset]) if offset != content_length else bytes(buf)
+
+
+def _verify_line_signature(body, signature):
+    """以 HMAC-SHA256 直接驗證 LINE webhook 簽章（不經過 SDK 的 handler 機制）"""
+    if not LINE_CHANNEL_SECRET or not signature:
+        return False
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    try:
+        return hmac.compare_digest(digest, base64.b64decode(signature))
+    except Exception:
+        return False
+
+
+def _dispatch_event(event):
+    """處理單一 webhook 事件：只關心影像訊息，其餘直接忽略"""
+    if event.get('type') != 'message':
+        return
+    message = event.get('message', {})
+    if message.get('type') != 'image':
+        return
+
+    message_id = message['id']
+    if not _inflight_messages.add(message_id):
+        logger.info(f"Duplicate webhook delivery for message {message_id}, skipping")
+        return
+
+    user_id = event.get('source', {}).get('userId')
+    reply_token = event.get('replyToken')
+
+    # 全域冷卻且沒有 OpenRouter 備援時，入口就同步回覆繁忙：
+    # 不下載影像、不佔 worker，也趁 reply token 還有效時把它用掉
+    if not OPENROUTER_API_KEY:
+        in_cooldown, remaining = _is_in_global_cooldown()
+        if in_cooldown:
+            logger.info(f"Global cooldown ({remaining}s left), fast-rejecting message {message_id}")
+            _send_busy_message(user_id, reply_token)
+            return
+
+    _submit_image_task(user_id, message_id, reply_token)
+
+
+def _submit_image_task(user_id, message_id, reply_token, attempt=0):
+    """把影像處理工作丟進執行緒池；佇列已滿時直接回覆繁忙訊息（優雅降載）"""
+    global _pending_tasks
+    with _pending_lock:
+        busy = _pending_tasks >= MAX_PENDING_TASKS
+        if not busy:
+            _pending_tasks += 1
+
+    if busy:
+        logger.warning(f"Task queue full ({MAX_PENDING_TASKS}), rejecting message {message_id}")
+        _send_busy_message(user_id, reply_token)
+        return
+
+    _EXECUTOR.submit(_run_image_task, user_id, message_id, reply_token, attempt)
+
+
+def _run_image_task(user_id, message_id, reply_token, attempt=0):
+    global _pending_tasks
+    try:
+        _process_image_async(user_id, message_id, reply_token, attempt)
+    finally:
+        _inflight_messages.pop(message_id)
+        with _pending_lock:
+            _pending_tasks -= 1
+
+
+# Gemini 全忙時的任務層重試：worker 不 time.sleep 乾等，改用 Timer 在
+# 退避時間後把工作重新丟回執行緒池，期間執行緒可以服務其他影像。
+MAX_TASK_RETRIES = 3
+TASK_RETRY_BASE_WAIT = 15   # 退避上限 15s, 30s, 60s（實際等待取 full jitter）
+
+
+def _schedule_retry(user_id, message_id, reply_token, attempt):
+    """排程下一次嘗試；等待時間採 AWS 建議的 full jitter（0 ～ 上限的均勻分布），
+    避免同批失敗的工作在冷卻結束的同一瞬間湧回"""
+    cap = min(TASK_RETRY_BASE_WAIT * (2 ** (attempt - 1)), 60)
+    wait = random.uniform(0, cap)
+    logger.info(
+        f"Gemini keys busy, retrying message {message_id} in {wait:.1f}s "
+        f"(attempt {attempt + 1}/{MAX_TASK_RETRIES})"
+    )
+    timer = threading.Timer(wait, _resubmit_image_task,
+                            args=(user_id, message_id, reply_token, attempt))
+    timer.daemon = True
+    timer.start()
+
+
+def _resubmit_image_task(user_id, message_id, reply_token, attempt):
+    # 重新登記 in-flight；失敗代表 LINE 重送已接手這個 message，不重複排
+    if not _inflight_messages.add(message_id):
+        logger.info(f"Message {message_id} reclaimed by a redelivery, dropping scheduled retry")
+        return
+    _submit_image_task(user_id, message_id, reply_token, attempt)
 
 
+def _send_busy_message(user_id, reply_token=None):
+    """通知使用者系統繁忙，稍後再試
+
+    被拒絕的事件不會再處理，reply token 反正要浪費掉，
+    優先拿來回覆（比 push 快、也不佔 push 額度），失敗才退回 push。
+    """
+    busy_text = TextMessage(text="寶寶現在有點忙碌，請稍後再傳一次照片給我哦 🍼💤")
+
+    if reply_token:
+        try:
+            _get_messaging_api().reply_message(
+                ReplyMessageRequest(reply_token=reply_token, messages=[busy_text])
+            )
+            return
+        except Exception as reply_err:
+            logger.warning(f"Busy reply failed ({reply_err}), falling back to push")
+
+    try:
+        _get_messaging_api().push_message(
+            PushMessageRequest(to=user_id, messages=[busy_text])
+        )
+    except Exception as e:
+        logger.error(f"Failed to send busy message: {e}")
 
 @app.route("/", methods=['GET'])
 def health_check():
@@ -109,23 +645,27 @@ def health_check():
 
 @app.route("/callback", methods=['POST'])
 def callback():
-    from linebot.v3.exceptions import InvalidSignatureError
-
+    # LINE 要求 webhook 在約 1 秒內回應，所以熱路徑只做三件事：
+    # 驗簽章 → 丟進執行緒池 → 回 OK
     signature = request.headers.get('X-Line-Signature', '')
-    body = request.get_data(as_text=True)
-    logger.info("Request body: " + body)
-
-    _, handler = get_line_config()
+    # cache=False：驗簽章與解析各只讀一次，省掉 Werkzeug 保留整包 body 副本的 memcpy
+    body = request.get_data(cache=False)
+    # 完整 body 只在 DEBUG 才輸出（且截斷），INFO 等級連格式化都不會發生
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Request body (%d bytes): %s', len(body), body[:512])
 
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if not _verify_line_signature(body, signature):
         logger.error("Invalid signature.")
         abort(400)
+
+    try:
+        for event in _json_loads(body).get('events', []):
+            _dispatch_event(event)
     except Exception as e:
         logger.error(f"Error in callback handler: {e}", exc_info=True)
 
-    return 'OK'
+    # 純 ack 回應：標頭直接給定，跳過 Flask 的自動推算
+    return Response(b'OK', status=200, headers={'Content-Type': 'text/plain', 'Content-Length': '2'})
 
 
 def _is_in_global_cooldown():
@@ -139,22 +679,100 @@ def _is_in_global_cooldown():
 
 
 def _throttle_request():
-    """確保連續請求之間有最小間隔，避免瞬間大量呼叫"""
+    """確保連續請求之間有最小間隔，避免瞬間大量呼叫
+
+    鎖內只「預約」自己的發射時刻，睡眠移到鎖外——原本抱著 _rate_lock
+    睡最多 2 秒，會把 token bucket、冷卻表等所有共享狀態一起卡住。
+    """
     global _last_request_time
     with _rate_lock:
         now = time.time()
-        elapsed = now - _last_request_time
-        if elapsed < MIN_REQUEST_INTERVAL:
-            wait = MIN_REQUEST_INTERVAL - elapsed
-            logger.info(f"Throttling: waiting {wait:.1f}s before next API call")
-            time.sleep(wait)
-        _last_request_time = time.time()
+        slot = max(now, _last_request_time + MIN_REQUEST_INTERVAL)
+        _last_request_time = slot
+        wait = slot - now
+    if wait > 0:
+        logger.info(f"Throttling: waiting {wait:.1f}s before next API call")
+        time.sleep(wait)
 
 
-def _call_gemini_with_rotation(genai, image_path, prompt, max_rounds=3):
-    """使用多把 API Key 輪替呼叫 Gemini，含速率限制、per-key 冷卻、指數退避重試"""
-    global _current_key_index, _global_cooldown_until
+def _generate_content(model, contents):
+    """呼叫 generate_content，優先使用設定的 service tier，必要時降回 Standard"""
+    global _service_tier_supported
 
+    if GEMINI_SERVICE_TIER and _service_tier_supported:
+        try:
+            return model.generate_content(
+                contents,
+                request_options={'service_tier': GEMINI_SERVICE_TIER},
+            )
+        except TypeError:
+            # 安裝中的 SDK 版本還不認得 service_tier，之後都直接走 Standard
+            _service_tier_supported = False
+            logger.warning("SDK does not support service_tier, using standard tier")
+        except Exception as e:
+            error_str = str(e)
+            if '429' in error_str or 'quota' in error_str.lower():
+                # Priority 配額滿時 API 會自動降回 Standard；保險起見自己再試一次
+                logger.warning(f"Service tier '{GEMINI_SERVICE_TIER}' quota hit, retrying on standard tier")
+            else:
+                raise
+
+    return model.generate_content(contents)
+
+
+def _get_prompt_cache(key_index):
+    """取得目前 key 對應的 prompt context cache，無法建立時回傳 None（改用 inline prompt）
+
+    cache 綁在建立它的 API key（專案）底下，所以每把 key 各存一份。
+    """
+    now = time.time()
+    cached = _prompt_caches.get(key_index)
+    if cached is not None and now < cached[1]:
+        return cached[0]
+
+    try:
+        cache = genai_caching.CachedContent.create(
+            model=f'models/{GEMINI_MODEL}',
+            display_name=f'{PROMPT_CACHE_KEY}-key{key_index + 1}',
+            system_instruction=ANALYSIS_PROMPT,
+            ttl=datetime.timedelta(seconds=PROMPT_CACHE_TTL),
+        )
+        _prompt_caches[key_index] = (cache, now + PROMPT_CACHE_TTL - PROMPT_CACHE_REFRESH_MARGIN)
+        logger.info(f"Prompt cache created for key #{key_index + 1}: {cache.name}")
+        return cache
+    except Exception as e:
+        # prompt 太短不符合 context caching 的最小 token 門檻時會走到這裡；
+        # 退回 inline prompt，一個 TTL 內不再重試
+        logger.info(f"Context caching unavailable for key #{key_index + 1} ({e}), using inline prompt")
+        _prompt_caches[key_index] = (None, now + PROMPT_CACHE_TTL)
+        return None
+
+
+def _upload_to_gemini(image_bytes):
+    """上傳影像到 Gemini Files API，小檔直接從記憶體送、超大檔才落地磁碟"""
+    if len(image_bytes) <= MAX_IN_MEMORY_IMAGE:
+        return genai.upload_file(
+            path=io.BytesIO(image_bytes),
+            mime_type='image/jpeg',
+            display_name='Ultrasound',
+        )
+
+    # 罕見的超大影像：寫進暫存檔避免多份大 buffer 佔住記憶體
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tf:
+        tf.write(image_bytes)
+        temp_path = tf.name
+    try:
+        return genai.upload_file(path=temp_path, display_name='Ultrasound')
+    finally:
+        os.remove(temp_path)
+
+
+def _call_gemini_with_rotation(image_bytes, prompt):
+    """使用多把 API Key 輪替呼叫 Gemini，含速率限制與 per-key 冷卻
+
+    只掃一輪：所有 key 都忙碌時丟出 GeminiKeysBusyError 交回任務層排程
+    重試，不在這裡 time.sleep 佔住 worker 執行緒。
+    """
     if not GEMINI_API_KEYS:
         raise ValueError("No Gemini API keys configured!")
 
@@ -166,139 +784,198 @@ def _call_gemini_with_rotation(genai, image_path, prompt, max_rounds=3):
         )
 
     last_error = None
+    keys_tried = 0
 
-    for round_num in range(max_rounds):
-        if round_num > 0:
-            wait_seconds = min(15 * (2 ** (round_num - 1)), 60)  # 15s, 30s, 60s
-            logger.info(f"All keys exhausted in round {round_num}, waiting {wait_seconds}s before retry...")
-            time.sleep(wait_seconds)
-
-        keys_tried = 0
-        keys_in_cooldown = 0
-
-        for attempt in range(len(GEMINI_API_KEYS)):
-            key_index = (_current_key_index + attempt) % len(GEMINI_API_KEYS)
-            now = time.time()
+    # 高分 key 優先；同分時以輪替起點為次序，讓健康度相同的 key 仍然均攤
+    start_index = next(_key_counter) % len(GEMINI_API_KEYS)
+    with _rate_lock:
+        key_order = sorted(
+            range(len(GEMINI_API_KEYS)),
+            key=lambda i: (-_key_scores.get(i, KEY_SCORE_MAX),
+                           (i - start_index) % len(GEMINI_API_KEYS)),
+        )
+    for key_index in key_order:
+        now = time.time()
 
-            # 2. 檢查此 key 是否在個別冷卻期
+        # 2. 檢查此 key 是否在個別冷卻期（冷卻表的讀寫一律在 _rate_lock 內，
+        # 無鎖的 get/set 交錯會漏看另一條執行緒剛寫入的冷卻）
+        with _rate_lock:
             cooldown_until = _key_cooldown.get(key_index, 0)
-            if now < cooldown_until:
-                remaining_cd = int(cooldown_until - now)
-                logger.info(f"Key #{key_index + 1} in cooldown ({remaining_cd}s left), skipping")
-                keys_in_cooldown += 1
-                continue
+        if now < cooldown_until:
+            remaining_cd = int(cooldown_until - now)
+            logger.info(f"Key #{key_index + 1} in cooldown ({remaining_cd}s left), skipping")
+            continue
 
-            keys_tried += 1
-            api_key = GEMINI_API_KEYS[key_index]
-            logger.info(f"[Round {round_num + 1}/{max_rounds}] Trying Key #{key_index + 1}/{len(GEMINI_API_KEYS)}")
+        # 3. token bucket：這把 key 的平滑額度用完就換下一把
+        if not _try_acquire_key_token(key_index):
+            logger.info(f"Key #{key_index + 1} throttled by token bucket, skipping")
+            continue
 
-            # 3. 限流：確保請求間隔
-            _throttle_request()
+        keys_tried += 1
+        logger.info(f"Trying Key #{key_index + 1}/{len(GEMINI_API_KEYS)}")
 
-            try:
-                genai.configure(api_key=api_key)
-                sample_file = genai.upload_file(path=image_path, display_name="Ultrasound")
-                logger.info(f"Using model: {GEMINI_MODEL}")
-                model = genai.GenerativeModel(GEMINI_MODEL)
-                response = model.generate_content([sample_file, prompt])
-
-                # 清理 Gemini 暫存
-                try:
-                    genai.delete_file(sample_file.name)
-                except Exception:
-                    pass
-
-                # 成功！更新索引到下一把，清除此 key 的冷卻
-                _current_key_index = (key_index + 1) % len(GEMINI_API_KEYS)
+        # 4. 限流：確保請求間隔
+        _throttle_request()
+
+        try:
+            # configure → 上傳 → prompt cache → generate 鎖成一段，
+            # 防止別條 worker 的 configure 插隊（見 _gemini_call_lock 註解）
+            with _gemini_call_lock:
+                _configure_gemini(key_index)
+                sample_file = _upload_to_gemini(image_bytes)
+                logger.info('Using model: %s', GEMINI_MODEL)
+                # 有 context cache 時 prompt 已存在伺服器端，只需送影像
+                prompt_cache = _get_prompt_cache(key_index)
+                model = _get_model(key_index, prompt_cache)
+                contents = [sample_file] if prompt_cache is not None else [sample_file, prompt]
+                response = _generate_content(model, contents)
+
+            # 清理 Gemini 暫存：丟進背景佇列批次刪除，不佔回覆的關鍵路徑
+            _file_cleanup_queue.put(sample_file.name)
+
+            # 成功！清除此 key 的冷卻並讓健康分數緩慢回血
+            with _rate_lock:
                 _key_cooldown.pop(key_index, None)
-                return response
+            _bump_key_score(key_index, KEY_SCORE_SUCCESS_GAIN)
+            return response
 
-            except Exception as e:
-                last_error = e
-                error_str = str(e)
-                if '429' in error_str or 'ResourceExhausted' in error_str or 'quota' in error_str.lower():
-                    # 4. 記錄此 key 的冷卻截止時間
-                    _key_cooldown[key_index] = time.time() + PER_KEY_COOLDOWN
-                    logger.warning(
-                        f"Key #{key_index + 1} hit 429, cooldown {PER_KEY_COOLDOWN}s until "
-                        f"{time.strftime('%H:%M:%S', time.localtime(_key_cooldown[key_index]))}"
-                    )
-                    continue
-                else:
-                    raise
-
-        # 如果這一輪所有 key 都在冷卻中（沒有實際嘗試），直接跳出
-        if keys_tried == 0:
-            logger.warning("All keys are in per-key cooldown, no keys available to try")
-            break
-
-    # 5. 所有嘗試失敗 ➜ 啟動全域冷卻，防止後續請求繼續連打
-    _global_cooldown_until = time.time() + GLOBAL_COOLDOWN
-    logger.error(
-        f"All {len(GEMINI_API_KEYS)} keys exhausted after {max_rounds} rounds. "
-        f"Global cooldown activated until {time.strftime('%H:%M:%S', time.localtime(_global_cooldown_until))}"
-    )
-    raise QuotaExhaustedError(
-        f"所有 {len(GEMINI_API_KEYS)} 把 API Key 配額耗盡，已啟動 {GLOBAL_COOLDOWN} 秒全域冷卻"
+        except Exception as e:
+            last_error = e
+            error_str = str(e)
+            if '429' in error_str or 'ResourceExhausted' in error_str or 'quota' in error_str.lower():
+                # 5. 記錄此 key 的冷卻截止時間（尊重官方 Retry-After）並扣健康分數
+                cooldown = _retry_after_from_error(e, error_str, PER_KEY_COOLDOWN)
+                cooldown_until = time.time() + cooldown
+                with _rate_lock:
+                    _key_cooldown[key_index] = cooldown_until
+                _bump_key_score(key_index, -KEY_SCORE_FAIL_PENALTY)
+                logger.warning(
+                    f"Key #{key_index + 1} hit 429, cooldown {cooldown}s until "
+                    f"{time.strftime('%H:%M:%S', time.localtime(cooldown_until))}"
+                )
+                continue
+            elif ('401' in error_str or '403' in error_str
+                    or 'PermissionDenied' in error_str
+                    or 'API key not valid' in error_str):
+                # 認證失敗短期內不會自己好，長冷卻＋分數歸零後換下一把
+                with _rate_lock:
+                    _key_cooldown[key_index] = time.time() + AUTH_FAILURE_COOLDOWN
+                _bump_key_score(key_index, -KEY_SCORE_MAX)
+                logger.error(f"Key #{key_index + 1} auth failure, cooling down 24h: {error_str[:200]}")
+                continue
+            else:
+                raise
+
+    # 6. 這一輪沒有 key 能用（全在冷卻／限流或全部 429）➜ 交給任務層稍後重試
+    if keys_tried == 0:
+        logger.warning("All keys are in per-key cooldown or throttled, none tried")
+        raise GeminiKeysBusyError("所有 API Key 都在冷卻或限流中")
+    raise GeminiKeysBusyError(
+        f"這一輪嘗試的 {keys_tried} 把 key 全數失敗"
+    ) from last_error
+
+
+# OpenRouter 備援專用的小執行緒池：三個免費模型同時發出，取最先成功者。
+# 免費模型慢起來一個就能拖 60 秒，逐一嘗試最糟要等 180 秒；
+# 並發後等待時間從「各模型延遲總和」變成「最快成功者的延遲」。
+_openrouter_executor = None
+_openrouter_executor_lock = threading.Lock()
+
+
+def _get_openrouter_executor():
+    global _openrouter_executor
+    if _openrouter_executor is None:
+        with _openrouter_executor_lock:
+            if _openrouter_executor is None:
+                _openrouter_executor = ThreadPoolExecutor(
+                    max_workers=len(OPENROUTER_FREE_MODELS) * 2,
+                    thread_name_prefix='openrouter',
+                )
+                atexit.register(_openrouter_executor.shutdown, wait=False)
+    return _openrouter_executor
+
+
+def _openrouter_request(model, payload_base):
+    """對單一 OpenRouter 模型發出請求；成功回傳文字，失敗丟例外
+
+    payload 的共用部分（含 base64 影像）以參照共享，每個模型只補 model 欄位。
+    """
+    resp = _openrouter_session.post(
+        OPENROUTER_BASE_URL,
+        json={'model': model, **payload_base},
+        timeout=60
     )
+    if resp.status_code == 200:
+        return resp.json()['choices'][0]['message']['content']
+    if resp.status_code == 429:
+        # 照 Retry-After 冷卻這個模型，下一次備援就不浪費名額在它身上
+        retry_after = resp.headers.get('Retry-After')
+        try:
+            cooldown = max(1, int(float(retry_after))) if retry_after else OPENROUTER_MODEL_COOLDOWN
+        except (TypeError, ValueError):
+            cooldown = OPENROUTER_MODEL_COOLDOWN
+        _openrouter_model_cooldown[model] = time.time() + cooldown
+        logger.warning(f"[OpenRouter] {model} rate limited, cooldown {cooldown}s")
+    raise Exception(f"OpenRouter {model} returned {resp.status_code}: {resp.text[:200]}")
 
 
-def _call_openrouter_fallback(image_path, prompt):
-    """使用 OpenRouter 免費 vision 模型作為備援"""
+def _call_openrouter_fallback(image_bytes, prompt):
+    """使用 OpenRouter 免費 vision 模型作為備援（並發嘗試，先成功先贏）"""
     if not OPENROUTER_API_KEY:
         raise ValueError("OPENROUTER_API_KEY not configured")
 
-    # 將圖片轉為 base64
-    with open(image_path, 'rb') as f:
-        image_b64 = base64.b64encode(f.read()).decode('utf-8')
+    # 將圖片轉為 base64（payload 只建一份，所有模型共用）
+    image_b64 = base64.b64encode(image_bytes).decode('utf-8')
 
-    headers = {
-        'Authorization': f'Bearer {OPENROUTER_API_KEY}',
-        'Content-Type': 'application/json',
-        'HTTP-Referer': 'https://baby-bot.onrender.com',
-        'X-Title': 'Baby Bot',
+    payload_base = {
+        'messages': [
+            {
+                'role': 'user',
+                'content': [
+                    {'type': 'text', 'text': prompt},
+                    {
+                        'type': 'image_url',
+                        'image_url': {
+                            'url': f'data:image/jpeg;base64,{image_b64}'
+                        }
+                    }
+                ]
+            }
+        ],
+        'max_tokens': 1024,
     }
 
-    messages = [
-        {
-            'role': 'user',
-            'content': [
-                {'type': 'text', 'text': prompt},
-                {
-                    'type': 'image_url',
-                    'image_url': {
-                        'url': f'data:image/jpeg;base64,{image_b64}'
-                    }
-                }
-            ]
-        }
-    ]
+    # 冷卻中的模型先跳過；全都在冷卻時照樣全試——備援沒有再往後退的空間
+    now = time.time()
+    models = [m for m in OPENROUTER_FREE_MODELS
+              if now >= _openrouter_model_cooldown.get(m, 0)]
+    if not models:
+        models = OPENROUTER_FREE_MODELS
+
+    executor = _get_openrouter_executor()
+    futures = {
+        executor.submit(_openrouter_request, model, payload_base): model
+        for model in models
+    }
+    logger.info(f"[OpenRouter] Racing {len(futures)} models...")
 
     last_error = None
-    for model in OPENROUTER_FREE_MODELS:
-        logger.info(f"[OpenRouter] Trying model: {model}")
-        try:
-            resp = requests.post(
-                OPENROUTER_BASE_URL,
-                headers=headers,
-                json={'model': model, 'messages': messages, 'max_tokens': 1024},
-                timeout=60
-            )
-
-            if resp.status_code == 200:
-                data = resp.json()
-                text = data['choices'][0]['message']['content']
+    try:
+        for future in as_completed(futures, timeout=75):
+            model = futures[future]
+            try:
+                text = future.result()
                 logger.info(f"[OpenRouter] Success with {model}")
                 return text
-            else:
-                logger.warning(f"[OpenRouter] {model} returned {resp.status_code}: {resp.text[:200]}")
-                last_error = Exception(f"OpenRouter {resp.status_code}: {resp.text[:200]}")
-                continue
-
-        except Exception as e:
-            logger.warning(f"[OpenRouter] {model} failed: {e}")
-            last_error = e
-            continue
+            except Exception as e:
+                logger.warning(f"[OpenRouter] {model} failed: {e}")
+                last_error = e
+    except FuturesTimeoutError as e:
+        last_error = e
+    finally:
+        # 還沒開跑的取消；已在途的 HTTP 請求無法中斷，結果直接丟棄
+        for future in futures:
+            future.cancel()
 
     if last_error is not None:
         raise last_error
@@ -318,266 +995,306 @@ ANALYSIS_PROMPT = """
 """.strip()
 
 
-def _parse_ai_response(response_text):
-    """解析 AI 回傳的 JSON 文字"""
-    text = response_text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
+# markdown code fence 的去殼 regex（一次比對取代多段 startswith 切片，
+# 也涵蓋 ```JSON／``` json 這類大小寫與空白變形）
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*(.*?)\s*```\s*$', re.IGNORECASE | re.DOTALL)
+
+
+def _parse_ai_response(response_text, strip_fences=True):
+    """解析 AI 回傳的 JSON 文字
+
+    Gemini 走結構化輸出（response_mime_type=application/json），回的是
+    乾淨 JSON，可以跳過去殼直接解析；OpenRouter 的免費模型沒有這個保證，
+    仍需經過 fence regex。
+    """
+    if strip_fences:
+        m = _FENCE_RE.match(response_text)
+        text = m.group(1) if m else response_text.strip()
+    else:
+        text = response_text
 
     try:
-        return json.loads(text.strip())
-    except json.JSONDecodeError as e:
+        return _json_loads(text)
+    except ValueError as e:  # 同時涵蓋 json 與 orjson 的 JSONDecodeError
         logger.error(f"JSON parse failed: {e}, raw: {text[:300]}")
         return {
             "weeks": "?",
             "message": text[:300] if text else "媽咪好！我看不太清楚，可以再傳一次清晰的照片嗎？",
             "weight_status": "未知",
-            "suggested_color": "#ffcccc"
+            "suggested_color": "#ffcccc",
+            # 標記給呼叫端：這是解析失敗的佔位回應，不可寫進結果快取
+            "_parse_failed": True,
         }
 
 
-def _process_image_async(user_id, message_id, reply_token):
-    """在背景處理圖片 — Gemini 優先，OpenRouter 備援"""
-    import google.generativeai as genai
-    from linebot.v3.messaging import (
-        ApiClient,
-        MessagingApi,
-        MessagingApiBlob,
-        ReplyMessageRequest,
-        PushMessageRequest,
-        TextMessage,
-        FlexMessage,
-        FlexContainer
-    )
-
-    config, _ = get_line_config()
-
-    temp_file_path = None
-
-    try:
-        # 1. 取得圖片內容
-        logger.info(f"[1/4] Downloading image: {message_id}")
-        with ApiClient(config) as api_client:
-            line_bot_blob_api = MessagingApiBlob(api_client)
-            message_content = line_bot_blob_api.get_message_content(message_id)
-
-        # 將圖片存入暫存檔
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tf:
-            if isinstance(message_content, bytes):
-                tf.write(message_content)
-            elif hasattr(message_content, 'read'):
-                tf.write(message_content.read())
-            elif hasattr(message_content, 'content'):
-                tf.write(message_content.content)
-            else:
-                tf.write(bytes(message_content))
-            temp_file_path = tf.name
-
-        file_size = os.path.getsize(temp_file_path)
-        logger.info(f"[2/4] Image saved: {temp_file_path} ({file_size} bytes)")
+# --- Flex Message 模板 ---
+# 每次回覆都重建 30 幾個 key 的 dict 再交給 from_dict 逐欄驗證太浪費，
+# import 時先把模板序列化成 JSON 字串，回覆時只替換動態欄位、解析一次。
 
-        if file_size == 0:
-            raise ValueError("Downloaded image is empty (0 bytes)")
-
-        # 2. 分析圖片：先 Gemini，失敗則用 OpenRouter 備援
-        logger.info("[3/4] Analyzing image...")
-        response_text = None
-        used_provider = None
-
-        # --- 嘗試 Gemini ---
-        if GEMINI_API_KEYS:
-            try:
-                logger.info("Trying Gemini first...")
-                response = _call_gemini_with_rotation(genai, temp_file_path, ANALYSIS_PROMPT)
-                response_text = response.text.strip()
-                used_provider = 'Gemini'
-            except (QuotaExhaustedError, Exception) as gemini_err:
-                logger.warning(f"Gemini failed: {gemini_err}")
-
-        # --- Gemini 失敗，嘗試 OpenRouter ---
-        if response_text is None and OPENROUTER_API_KEY:
-            try:
-                logger.info("Falling back to OpenRouter...")
-                response_text = _call_openrouter_fallback(temp_file_path, ANALYSIS_PROMPT)
-                used_provider = 'OpenRouter'
-            except Exception as or_err:
-                logger.error(f"OpenRouter also failed: {or_err}")
-
-        # --- 都失敗 ---
-        if response_text is None:
-            raise Exception("所有 AI 服務都無法使用（Gemini + OpenRouter）")
-
-        logger.info(f"AI response from {used_provider}: {response_text[:200]}")
-
-        # 3. 解析 JSON
-        result_json = _parse_ai_response(response_text)
-
-
-
-        # 4. 組裝 Flex Message 並回傳
-        logger.info("[4/4] Sending Flex Message...")
-
-        weeks = result_json.get('weeks', '?')
-        message = result_json.get('message', '媽咪好，我是寶寶！')
-        weight_status = result_json.get('weight_status', '')
-        bg_color = result_json.get('suggested_color', '#FFF0F5')
+# 溫馨的寶寶主題圖片（使用免費圖庫），依週數輪流選用增加變化感
+_FLEX_HERO_IMAGES = [
+    "https://images.unsplash.com/photo-1555252333-9f8e92e65df9?w=800&h=400&fit=crop",
+    "https://images.unsplash.com/photo-1519689680058-324335c77eba?w=800&h=400&fit=crop",
+    "https://images.unsplash.com/photo-1544126592-807ade215a0b?w=800&h=400&fit=crop",
+]
 
-        # 溫馨的寶寶主題圖片（使用免費圖庫）
-        hero_images = [
-            "https://images.unsplash.com/photo-1555252333-9f8e92e65df9?w=800&h=400&fit=crop",
-            "https://images.unsplash.com/photo-1519689680058-324335c77eba?w=800&h=400&fit=crop",
-            "https://images.unsplash.com/photo-1544126592-807ade215a0b?w=800&h=400&fit=crop",
-        ]
-        # 根據週數選不同圖片（增加變化感）
-        try:
-            img_index = int(str(weeks)) % len(hero_images)
-        except (ValueError, TypeError):
-            img_index = 0
-        hero_url = hero_images[img_index]
-
-        flex_dict = {
-            "type": "bubble",
-            "size": "giga",
-            "hero": {
-                "type": "image",
-                "url": hero_url,
-                "size": "full",
-                "aspectRatio": "20:10",
-                "aspectMode": "cover"
-            },
-            "header": {
+_FLEX_TEMPLATE = {
+    "type": "bubble",
+    "size": "giga",
+    "hero": {
+        "type": "image",
+        "url": "__HERO_URL__",
+        "size": "full",
+        "aspectRatio": "20:10",
+        "aspectMode": "cover"
+    },
+    "header": {
+        "type": "box",
+        "layout": "vertical",
+        "paddingAll": "16px",
+        "contents": [
+            {
                 "type": "box",
-                "layout": "vertical",
-                "paddingAll": "16px",
-                "contents": [
-                    {
-                        "type": "box",
-                        "layout": "horizontal",
-                        "contents": [
-                            {
-                                "type": "text",
-                                "text": "👶",
-                                "size": "xxl",
-                                "flex": 0
-                            },
-                            {
-                                "type": "box",
-                                "layout": "vertical",
-                                "contents": [
-                                    {
-                                        "type": "text",
-                                        "text": f"第 {weeks} 週",
-                                        "weight": "bold",
-                                        "size": "xxl",
-                                        "color": "#D4548E"
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": "成長紀錄 🍼",
-                                        "size": "sm",
-                                        "color": "#E88DB6"
-                                    }
-                                ],
-                                "paddingStart": "12px"
-                            }
-                        ],
-                        "alignItems": "center"
-                    }
-                ]
-            },
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "md",
-                "paddingAll": "20px",
+                "layout": "horizontal",
                 "contents": [
                     {
                         "type": "text",
-                        "text": message,
-                        "wrap": True,
-                        "size": "md",
-                        "color": "#555555",
-                        "lineSpacing": "8px"
-                    },
-                    {
-                        "type": "separator",
-                        "margin": "lg",
-                        "color": "#FFE4E1"
+                        "text": "👶",
+                        "size": "xxl",
+                        "flex": 0
                     },
                     {
                         "type": "box",
-                        "layout": "horizontal",
-                        "margin": "lg",
+                        "layout": "vertical",
                         "contents": [
                             {
                                 "type": "text",
-                                "text": "📊 體重狀態",
-                                "size": "sm",
-                                "color": "#AAAAAA",
-                                "flex": 0
+                                "text": "第 __WEEKS__ 週",
+                                "weight": "bold",
+                                "size": "xxl",
+                                "color": "#D4548E"
                             },
                             {
                                 "type": "text",
-                                "text": weight_status if weight_status else "—",
+                                "text": "成長紀錄 🍼",
                                 "size": "sm",
-                                "color": "#D4548E",
-                                "align": "end",
-                                "weight": "bold"
+                                "color": "#E88DB6"
                             }
-                        ]
+                        ],
+                        "paddingStart": "12px"
                     }
-                ]
+                ],
+                "alignItems": "center"
+            }
+        ]
+    },
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "spacing": "md",
+        "paddingAll": "20px",
+        "contents": [
+            {
+                "type": "text",
+                "text": "__MSG__",
+                "wrap": True,
+                "size": "md",
+                "color": "#555555",
+                "lineSpacing": "8px"
+            },
+            {
+                "type": "separator",
+                "margin": "lg",
+                "color": "#FFE4E1"
             },
-            "footer": {
+            {
                 "type": "box",
-                "layout": "vertical",
-                "paddingAll": "12px",
+                "layout": "horizontal",
+                "margin": "lg",
                 "contents": [
                     {
                         "type": "text",
-                        "text": "💕 寶寶健康成長中 💕",
-                        "size": "xs",
-                        "color": "#E88DB6",
-                        "align": "center"
+                        "text": "📊 體重狀態",
+                        "size": "sm",
+                        "color": "#AAAAAA",
+                        "flex": 0
+                    },
+                    {
+                        "type": "text",
+                        "text": "__WEIGHT__",
+                        "size": "sm",
+                        "color": "#D4548E",
+                        "align": "end",
+                        "weight": "bold"
                     }
                 ]
             }
-        }
+        ]
+    },
+    "footer": {
+        "type": "box",
+        "layout": "vertical",
+        "paddingAll": "12px",
+        "contents": [
+            {
+                "type": "text",
+                "text": "💕 寶寶健康成長中 💕",
+                "size": "xs",
+                "color": "#E88DB6",
+                "align": "center"
+            }
+        ]
+    }
+}
+_FLEX_JSON_TEMPLATE = _json_dumps(_FLEX_TEMPLATE)
 
-        flex_container = FlexContainer.from_dict(flex_dict)
-        flex_message = FlexMessage(alt_text="寶寶的超音波紀錄來囉！", contents=flex_container)
 
-        with ApiClient(config) as api_client:
-            line_bot_api = MessagingApi(api_client)
+def _json_escape(value):
+    """把動態文字轉成可直接嵌進 JSON 字串的形式（去掉外層引號）"""
+    return _json_dumps(str(value))[1:-1]
 
-            # 先嘗試 reply（如果 token 還有效）
-            try:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[flex_message]
-                    )
+
+def _build_flex_message(weeks, message, weight_status):
+    """以模板替換動態欄位組出 FlexMessage"""
+    # 根據週數選不同圖片（增加變化感）
+    try:
+        img_index = int(str(weeks)) % len(_FLEX_HERO_IMAGES)
+    except (ValueError, TypeError):
+        img_index = 0
+
+    json_str = (
+        _FLEX_JSON_TEMPLATE
+        .replace('__HERO_URL__', _FLEX_HERO_IMAGES[img_index])
+        .replace('__WEEKS__', _json_escape(weeks))
+        .replace('__MSG__', _json_escape(message))
+        .replace('__WEIGHT__', _json_escape(weight_status if weight_status else '—'))
+    )
+    flex_container = FlexContainer.from_json(json_str)
+    return FlexMessage(alt_text="寶寶的超音波紀錄來囉！", contents=flex_container)
+
+
+def _analyze_image(image_bytes):
+    """呼叫 AI 分析影像 — Gemini 優先，OpenRouter 備援，回傳解析後的 dict"""
+    response_text = None
+    used_provider = None
+
+    # --- 嘗試 Gemini ---
+    if GEMINI_API_KEYS:
+        try:
+            logger.info("Trying Gemini first...")
+            response = _call_gemini_with_rotation(image_bytes, ANALYSIS_PROMPT)
+            response_text = response.text.strip()
+            used_provider = 'Gemini'
+        except GeminiKeysBusyError:
+            # key 全忙：有 OpenRouter 就立刻備援，否則往上拋讓任務層排程重試
+            if not OPENROUTER_API_KEY:
+                raise
+            logger.warning("Gemini keys busy, falling back to OpenRouter")
+        except (QuotaExhaustedError, Exception) as gemini_err:
+            logger.warning(f"Gemini failed: {gemini_err}")
+
+    # --- Gemini 失敗，嘗試 OpenRouter ---
+    if response_text is None and OPENROUTER_API_KEY:
+        try:
+            logger.info("Falling back to OpenRouter...")
+            response_text = _call_openrouter_fallback(image_bytes, ANALYSIS_PROMPT)
+            used_provider = 'OpenRouter'
+        except Exception as or_err:
+            logger.error(f"OpenRouter also failed: {or_err}")
+
+    # --- 都失敗 ---
+    if response_text is None:
+        raise Exception("所有 AI 服務都無法使用（Gemini + OpenRouter）")
+
+    logger.info('AI response from %s: %s', used_provider, response_text[:200])
+    result = _parse_ai_response(response_text, strip_fences=(used_provider != 'Gemini'))
+    if used_provider != 'Gemini':
+        result['_from_fallback'] = True
+    return result
+
+
+def _process_image_async(user_id, message_id, reply_token, attempt=0):
+    """在背景處理圖片 — Gemini 優先，OpenRouter 備援"""
+    global _global_cooldown_until
+
+    try:
+        # 1. 取得圖片內容（整包留在記憶體，不再經過暫存檔）
+        logger.info('[1/4] Downloading image: %s', message_id)
+        image_bytes = _download_line_image(message_id)
+        logger.info('[2/4] Image downloaded: %d bytes', len(image_bytes))
+
+        if not image_bytes:
+            raise ValueError("Downloaded image is empty (0 bytes)")
+
+        # 縮圖後再交給 AI，上傳量與 vision token 都大幅下降
+        image_bytes = _prepare_image(image_bytes)
+
+        # 2. 分析圖片（重複的影像命中快取就完全跳過 AI）
+        cache_key = _image_cache_key(image_bytes)
+        result_json = _result_cache.get(cache_key)
+
+        if result_json is not None:
+            logger.info("[3/4] Result cache hit, skipping AI analysis")
+        else:
+            logger.info("[3/4] Analyzing image...")
+            result_json = _analyze_image(image_bytes)
+            # 解析失敗的佔位回應不能進快取——訊息要使用者「再傳一次」，
+            # 重傳同一張卻只會從快取拿回同一句失敗訊息，一鎖 24 小時。
+            # 備援模型的結果則用短 TTL，Gemini 恢復後還能重新分析
+            parse_failed = result_json.pop('_parse_failed', False)
+            from_fallback = result_json.pop('_from_fallback', False)
+            if not parse_failed:
+                _result_cache.set(cache_key, result_json,
+                                  ttl=FALLBACK_RESULT_TTL if from_fallback else None)
+
+        # 3. 組裝 Flex Message 並回傳
+        logger.info("[4/4] Sending Flex Message...")
+
+        weeks = result_json.get('weeks', '?')
+        message = result_json.get('message', '媽咪好，我是寶寶！')
+        weight_status = result_json.get('weight_status', '')
+
+        flex_message = _build_flex_message(weeks, message, weight_status)
+
+        line_bot_api = _get_messaging_api()
+
+        # 先嘗試 reply（如果 token 還有效）
+        try:
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[flex_message]
                 )
-                logger.info("Reply message sent successfully!")
-            except Exception as reply_err:
-                logger.warning(f"Reply failed ({reply_err}), using push message instead")
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[flex_message]
-                    )
+            )
+            logger.info("Reply message sent successfully!")
+        except Exception as reply_err:
+            logger.warning(f"Reply failed ({reply_err}), using push message instead")
+            line_bot_api.push_message(
+                PushMessageRequest(
+                    to=user_id,
+                    messages=[flex_message]
                 )
-                logger.info("Push message sent successfully!")
+            )
+            logger.info("Push message sent successfully!")
 
     except Exception as e:
+        # key 全忙且還有重試額度：排程稍後再試，先不打擾使用者
+        if isinstance(e, GeminiKeysBusyError) and attempt + 1 < MAX_TASK_RETRIES:
+            _schedule_retry(user_id, message_id, reply_token, attempt + 1)
+            return
+
         logger.error(f"Error processing image: {e}", exc_info=True)
 
         # 根據錯誤類型給出不同的友善訊息
-        if isinstance(e, QuotaExhaustedError):
+        if isinstance(e, GeminiKeysBusyError):
+            # 重試額度用完 ➜ 啟動全域冷卻，讓後續請求在入口就快速失敗
+            _global_cooldown_until = time.time() + GLOBAL_COOLDOWN
+            logger.error(
+                "All retries exhausted, global cooldown until "
+                f"{time.strftime('%H:%M:%S', time.localtime(_global_cooldown_until))}"
+            )
+            user_msg = "寶寶現在有點忙碌，請過幾分鐘再傳一次照片給我哦 🍼💤"
+        elif isinstance(e, QuotaExhaustedError):
             user_msg = "寶寶現在有點忙碌，請過幾分鐘再傳一次照片給我哦 🍼💤"
         elif '429' in str(e) or 'quota' in str(e).lower():
             user_msg = "寶寶現在有點忙碌，請過幾分鐘再傳一次照片給我哦 🍼💤"
@@ -585,20 +1302,21 @@ def _process_image_async(user_id, message_id, reply_token):
             user_msg = "抱歉，處理照片時出了點問題，請稍後再試 🙏"
 
         try:
-            with ApiClient(config) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=user_msg)]
-                    )
+            _get_messaging_api().push_message(
+                PushMessageRequest(
+                    to=user_id,
+                    messages=[TextMessage(text=user_msg)]
                 )
+            )
         except Exception as push_err:
             logger.error(f"Failed to send error message: {push_err}")
-    finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
 
 
 if __name__ == "__main__":
+    # 啟動前先暖機：genai.configure 與 LINE client 的首次初始化
+    # 在這裡付清，不留給第一個 webhook
+    if GEMINI_API_KEYS:
+        _configure_gemini(0)
+    if line_configuration:
+        _get_messaging_api()
     app.run(host="0.0.0.0", port=8000)